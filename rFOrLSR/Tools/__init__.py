@@ -1,16 +1,20 @@
 import re # regexp for the RegressorParser
+import functools # lru_cache for the IIR_Spectrum frequency responses
 import scipy.signal as sps
+import scipy.linalg as spl # solve_triangular for the ERR factorization
 import numpy as np
 import tqdm
 import torch as tor
 
 import matplotlib.pyplot as plt
 from matplotlib import patches # for the Unit circle of zPlanePlot
+from matplotlib.collections import LineCollection # single artist for all IIR_Spectrum filters
+from matplotlib.lines import Line2D # IIR_Spectrum legend handles
+from matplotlib.path import Path # IIR_Spectrum legend placement
 plt.style.use( 'dark_background' ) # black graphs
 
 # Library internal imports from sibling folders
 from .. import CTors
-from .. import HelperFuncs as HF
 
 ################################################################################################################################################
 ####                                                                                                                                       #####
@@ -19,6 +23,8 @@ from .. import HelperFuncs as HF
 ################################################################################################################################################
 
 # ############################################################### FOrLSR to IIR #############################################################
+_LinearRegressorPattern = re.compile( r'([xy])\[k-(\d+)\]' ) # Regexpr pattern to match terms like x[k-j] or y[k-j], compiled once
+
 def rFOrLSR2IIR( theta, L, RegNames ):
   """Converts the FOrLSR Output into a a,b IIR filter coefficient vectors.
   There is no guarantee on the order of the regressors so some matching is required. Additionally, y[k-j] terms are sign flipped (IIR convention).
@@ -34,42 +40,86 @@ def rFOrLSR2IIR( theta, L, RegNames ):
   """
 
   def RegressorParser( term ):
+    if ( term == 'x[k]' ): return ( 'x', 0 ) # Special case for x[k-0]
     
-    pattern = re.compile( r'([xy])\[(k-\d+)\]' ) # Regexpr pattern to match terms like x[k-j] or y[k-j]
-
-    # Special case for x[k-0]
-    if ( term == 'x[k]' ): return ( 'x', 0 )
-    
-    match = pattern.match( term )
-    if ( match ):
-      # Extract the variable (x or y) and the delay (j)
-      variable, delay = match.groups()
-      delay = int( delay.split( '-' )[1] )
-      return ( variable, delay )
+    match = _LinearRegressorPattern.match( term )
+    if ( match ): return ( match.group( 1 ), int( match.group( 2 ) ) ) # Extract the variable (x or y) and the delay (j)
     
     raise ValueError( f"Invalid term: { term }. This function is only for linear IIRs (→ x[k-j], y[k-j] terms)" )
 
   # Parse regressor names
-  CoeffList = []
-  for i in range( len( theta ) ):
-    variable, delay = RegressorParser( RegNames[ L[i] ] )
-    CoeffList.append( ( theta[i], variable, delay ) )
-
-  # first we need to find the respective maximum lags for x and y
-  MaxLag = max( [ CoeffList[i][2] for i in range( len( CoeffList ) ) ] ) # get max delay
+  Variables, Delays = zip( *[ RegressorParser( RegNames[ L[i] ] ) for i in range( len( theta ) ) ] )
+  Variables = np.array( Variables ); Delays = np.array( Delays )
+  theta = np.asarray( theta, dtype = float )
 
   # + 1 for x/y[k]
-  a = np.zeros( MaxLag + 1, dtype = float ); a[0] = 1.0 # y[k]/a0 is normed due to FOrLSR structure
-  b = np.zeros( MaxLag + 1, dtype = float ) # for x[k]
+  a = np.zeros( Delays.max() + 1, dtype = float ); a[0] = 1.0 # y[k]/a0 is normed due to FOrLSR structure
+  b = np.zeros( Delays.max() + 1, dtype = float ) # for x[k]
 
-  for i in range( len( CoeffList ) ):
-    if ( CoeffList[i][1] == 'x' ): b[ CoeffList[i][2] ] = CoeffList[i][0]
-    if ( CoeffList[i][1] == 'y' ): a[ CoeffList[i][2] ] = - CoeffList[i][0] # - since in the regressions the y terms are on the other side
+  IsX = ( Variables == 'x' ); IsY = ( Variables == 'y' )
+  b[ Delays[IsX] ] = theta[IsX]
+  a[ Delays[IsY] ] = - theta[IsY] # - since in the regressions the y terms are on the other side
 
   return ( b, a )
 
 
+#   ############################################################### IIR Spectrum helpers #############################################################
+def _MagnitudePhase( h ):
+  """Returns the magnitude in dB (clipped at -120 dB to avoid zero-division warnings) and the unwrapped phase in radians of the complex frequency response h"""
+  Magnitude = np.abs( h ).astype( float, copy = False ) # only allocation of the magnitude computation, everything below is in place
+  np.maximum( Magnitude, 1e-06, out = Magnitude ); np.log10( Magnitude, out = Magnitude ); Magnitude *= 20
+  
+  return ( Magnitude, np.unwrap( np.angle( h ) ) ) # np.unwrap has no out argument
+
+
+@functools.lru_cache( maxsize = 128 )
+def _b_a_Spectrum( b, a, Fs, Resolution ):
+  """Memoized frequency response of the (b, a) filter, such that re-plotting the same filters skips the spectrum computation.
+  
+  ### Inputs:
+  - `b`: (tuple of floats) containing the numerator coefficients
+  - `a`: (tuple of floats) containing the denominator coefficients
+  - `Fs`: (float) containing the Sampling frequency
+  - `Resolution`: (int) containing the number of frequency bins
+
+  ### Outputs:
+  - `w`: (1D read-only np.array) containing the frequency axis [0, Fs/2[
+  - `Magnitude`: (1D read-only np.array) containing the magnitude response in dB
+  - `Phase`: (1D read-only np.array) containing the unwrapped phase response in radians
+  """
+  b = np.array( b ); a = np.array( a )
+
+  if ( max( len( b ), len( a ) ) <= 2 * Resolution ): # rfft evaluates the polynomials on freqz's grid, valid as long as no coefficients wrap around
+    w = np.linspace( 0, Fs / 2, Resolution, endpoint = False ) # same grid as freqz: [0, Fs/2[
+    h = np.fft.rfft( b, n = 2 * Resolution )[ : Resolution ]
+    if ( len( a ) == 1 ): h /= a[0] # FIR: only a gain
+    else:                 h /= np.fft.rfft( a, n = 2 * Resolution )[ : Resolution ]
+  
+  else: w, h = sps.freqz( b, a, worN = Resolution, fs = Fs ) # more coefficients than frequency bins, let scipy handle it
+
+  Magnitude, Phase = _MagnitudePhase( h )
+  for Array in ( w, Magnitude, Phase ): Array.flags.writeable = False # cached arrays are shared between all calls, so protect them
+
+  return ( w, Magnitude, Phase )
+
+
 #   ############################################################### IIR Spectrum #############################################################
+_LegendLocations = ( "upper right", "upper left", "lower left", "lower right", "center left", "center right", "lower center", "upper center", "center" ) # loc = "best"'s candidates, in its order of preference
+
+def _PlaceLegend( Ax, Handles, Names, Segments ):
+  '''Adds the legend at the location overlapping the curves the least, scored like loc = "best" which ignores LineCollection paths and would thus cover the curves'''
+  Paths = []
+  for Segment in Segments:
+    Points = Ax.transData.transform( Segment ) # display coordinates, respecting the log-scale
+    Paths.append( Path( Points[ np.isfinite( Points ).all( axis = 1 ) ] ) ) # w = 0 lies at -inf on the log-scale
+
+  Overlaps = []
+  for Location in _LegendLocations: # badness = number of vertices in the box + number of curves crossing it
+    Box = Ax.legend( Handles, Names, loc = Location ).get_window_extent()
+    Overlaps.append( sum( Box.count_contains( Curve.vertices ) + Curve.intersects_bbox( Box, filled = False ) for Curve in Paths ) )
+  
+  Ax.legend( Handles, Names, loc = _LegendLocations[ np.argmin( Overlaps ) ] ) # argmin keeps the first best, as loc = "best" does
+
 def IIR_Spectrum( b_a_List = None, h_List = None, FilterNames = None, Fs = 44_100, Resolution = 5_000, xLims = None, yLimMag = None ):
   """Plots the magnitude and phase spectrum of the passed IIR-filters.
   The Magnitude response if plotted as: 20 * np.log10( np.maximum( abs( h ), 1e-06 ) ) to avoid zero-division warnings
@@ -125,6 +175,7 @@ def IIR_Spectrum( b_a_List = None, h_List = None, FilterNames = None, Fs = 44_10
   # ************************************************************** Plots **************************************************************
   Fig, Ax = plt.subplots( 2, 1, sharex = True )
   Ax[0].set_title( 'Frequency Response' ) # randomly Ax[0], Ax[1] also valid
+  Ax[0].set_xscale( 'log' ) # once for both, since sharex
 
   # Prepare magnitude response
   Ax[0].set_xlabel( 'Frequency [Hz]' )
@@ -138,37 +189,74 @@ def IIR_Spectrum( b_a_List = None, h_List = None, FilterNames = None, Fs = 44_10
   Ax[1].set_ylabel( 'Phase [Radians]' )
   Ax[1].grid( which = 'both', alpha = 0.2 )
 
-  # Plot the actual frequency responses
+  # Compute the actual frequency responses, plotted afterwards as one LineCollection per axis rather than one line per filter
+  Segments_Mag = []; Segments_Phase = []
   for coeffs in CoeffList:
 
-    if ( Coeff_Type == "b_a" ):
-      w, h = sps.freqz( coeffs[0], coeffs[1], worN = Resolution, fs = Fs ) # expect b then a coeffs
+    if ( Coeff_Type == "b_a" ): # expect b then a coeffs, passed as tuples to be hashable for the cache
+      w, Magnitude, Phase = _b_a_Spectrum( tuple( np.atleast_1d( np.asarray( coeffs[0], dtype = float ) ) ),
+                                           tuple( np.atleast_1d( np.asarray( coeffs[1], dtype = float ) ) ), float( Fs ), int( Resolution ) )
     else: # Coeff_Type == "h"
       w = np.linspace( 0, Fs / 2, Resolution, endpoint = True )
-      h = coeffs
-
-    Magnitude = 20 * np.log10( np.maximum( abs( h ), 1e-06 ) )
+      Magnitude, Phase = _MagnitudePhase( coeffs )
     
-    if ( UpdateLowLim ):  yLimMag[0] = np.min( ( yLimMag[0], np.min( Magnitude ) ) )
-    if ( UpdateHighLim ): yLimMag[1] = np.max( ( yLimMag[1], np.max( Magnitude ) ) )
+    if ( UpdateLowLim ):  yLimMag[0] = min( yLimMag[0], Magnitude.min() )
+    if ( UpdateHighLim ): yLimMag[1] = max( yLimMag[1], Magnitude.max() )
 
-    # plot
-    Ax[0].semilogx( w, Magnitude )
-    Ax[1].semilogx( w, np.unwrap( np.angle( h ) ) )
+    Segments_Mag.append( np.column_stack( ( w, Magnitude ) ) )
+    Segments_Phase.append( np.column_stack( ( w, Phase ) ) )
   
+  # plot, using the usual color cycle
+  CycleColors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+  Colors = [ CycleColors[ i % len( CycleColors ) ] for i in range( len( CoeffList ) ) ]
+  Ax[0].add_collection( LineCollection( Segments_Mag, colors = Colors ) )
+  Ax[1].add_collection( LineCollection( Segments_Phase, colors = Colors ) )
+  Ax[1].autoscale_view() # the magnitude's y-limits are set below
+
   # add small margins for aesthetics
   if ( UpdateLowLim ):  yLimMag[0] = yLimMag[0] - 2
   if ( UpdateHighLim ): yLimMag[1] = yLimMag[1] + 2
   Ax[0].set_ylim( yLimMag[0], yLimMag[1] )
 
-  Ax[0].legend( FilterNames )
-  Ax[1].legend( FilterNames )
+  Fig.tight_layout() # before the legends since their placement depends on the final axes geometry
 
-  Fig.tight_layout()
+  Handles = [ Line2D( [], [], color = Color ) for Color in Colors ] # one legend entry per filter, as the collection is a single artist
+  _PlaceLegend( Ax[0], Handles, FilterNames, Segments_Mag )
+  _PlaceLegend( Ax[1], Handles, FilterNames, Segments_Phase )
 
   return ( Fig, Ax )
 
 
+#   ############################################################### zPlanePlot helpers #############################################################
+_TickLimits =   np.array( [ 1.5, 5, 10, 25, 50, 100 ] ) # zPlanePlot axis limits from which on the next tick spacing is used
+_TickSpacings = np.array( [ 0.25, 0.5, 1, 2, 5, 10, 100 ] )
+
+def _Roots( Coeffs ):
+  """Same as np.roots but solves polynomials of degree <= 2 in closed form, skipping the companion matrix construction and LAPACK eigenvalue solver of the common low-order filters.
+  Degrees 3 and 4 deliberately still use np.roots, as the Cardano and Ferrari formulas are numerically unreliable for close or multiple roots.
+  
+  ### Inputs:
+  - `Coeffs`: (1D float iterable) containing the polynomial coefficients, highest power first
+
+  ### Outputs:
+  - `Roots`: (1D complex np.array) containing the polynomial roots
+  """
+  Coeffs = np.trim_zeros( np.atleast_1d( np.asarray( Coeffs, dtype = float ) ), 'f' ) # leading zeros don't change the roots
+  if ( len( Coeffs ) > 3 ): return ( np.roots( Coeffs ) )
+
+  nZeros = len( Coeffs ) - len( np.trim_zeros( Coeffs, 'b' ) ) # trailing zeros are roots at the origin
+  Coeffs = Coeffs[ : len( Coeffs ) - nZeros ]
+
+  if   ( len( Coeffs ) <= 1 ): Roots = np.empty( 0, dtype = complex ) # constant
+  elif ( len( Coeffs ) == 2 ): Roots = np.array( [ -Coeffs[1] / Coeffs[0] ], dtype = complex ) # linear
+  else: # quadratic, numerically stable form avoiding the cancellation of -b ± sqrt( b^2 - 4ac )
+    a, b, c = Coeffs
+    q = -0.5 * ( b + np.copysign( 1.0, b ) * np.sqrt( complex( b * b - 4 * a * c ) ) ) # c != 0, so q != 0
+    Roots = np.array( [ q / a, c / q ] )
+
+  return ( np.concatenate( ( Roots, np.zeros( nZeros, dtype = complex ) ) ) )
+
+
 #   ############################################################### zPlanePlot #############################################################
 def zPlanePlot( b, a = 1, Title = None ):
   """Plot the poles and zeros of the passed filter in the z-plane.
@@ -196,8 +284,8 @@ def zPlanePlot( b, a = 1, Title = None ):
   a /= k_denom
         
   # Compute poles and zeros
-  z = np.roots( b ) # Zeros
-  p = np.roots( a ) # Poles
+  z = _Roots( b ) # Zeros
+  p = _Roots( a ) # Poles
   k = k_num / k_denom # Gain
     
   # Plot the zeros and set marker properties    
@@ -216,14 +304,8 @@ def zPlanePlot( b, a = 1, Title = None ):
   Lim = 0.1 + max( 1, np.max( np.abs( z ) ), np.max( np.abs( p ) ) ) # minimum of 1.1 to include UC
   Ax.set_xlim( -Lim, Lim ); Ax.set_ylim( -Lim, Lim )
 
-  # declutter the axis if many ticks. Safeguard for Matplotlib taking ages and tons of RAM
-  if   ( Lim >= 100 ): TickSpacing = 100 # pretty instable filter though :P
-  elif ( Lim >= 50 ):  TickSpacing = 10
-  elif ( Lim >= 25 ):  TickSpacing = 5
-  elif ( Lim >= 10 ):  TickSpacing = 2
-  elif ( Lim >= 5 ):   TickSpacing = 1
-  elif ( Lim >= 1.5 ): TickSpacing = 0.5
-  else:                TickSpacing = 0.25
+  # declutter the axis if many ticks. Safeguard for Matplotlib taking ages and tons of RAM. Lim >= 100 is a pretty instable filter though :P
+  TickSpacing = _TickSpacings[ np.searchsorted( _TickLimits, Lim, side = 'right' ) ] # Lim >= _TickLimits[i] → _TickSpacings[i+1]
 
   nTicks = int( Lim / TickSpacing ) # floored entire number of ticks on one side
   FurthestTick = TickSpacing * ( nTicks + 1 )
@@ -243,40 +325,86 @@ def zPlanePlot( b, a = 1, Title = None ):
 ####                                                                                                                                       #####
 ################################################################################################################################################
 
+# ############################################################################ ERR Factorization #############################################################################
+def _ExtendERR( G, c, s2y, State = None, Capacity = None ):
+  ''' Kernel of ComputeERR: MGS expressed in the Gram matrix, such that Omega is never materialized.
+  The k regressors factorized in `State` are reused as is and only the m = K - k new regressors are orthogonalized, which allows to grow a regressor set without redoing the prefix.
+  The kernel only works on K-sized data, so it runs in numpy on the CPU: this avoids a device synchronization (.item() / comparisons) and a torch dispatch per operation.
+  
+  ### Inputs:
+  - `G`: ((K, m) torch.Tensor) containing the Gram matrix columns of the m new regressors against all K regressors, the k already factorized ones first
+  - `c`: ((m,) torch.Tensor) containing the projections of the (centered) system output on the m new regressors
+  - `s2y`: (float) containing the squared norm of the (centered) system output
+  - `State`: (Optional: tuple) containing the ( R, z, ERR ) factorization of the k first regressors as returned by a previous call, None if k = 0. Its buffers are updated in place
+  - `Capacity`: (Optional: int >= K) number of regressors the R and z buffers are pre-allocated for, such that growing the factorization up to that size doesn't reallocate
+
+  ### Outputs:
+  - `ERR`: (np.array of float) containing the error reduction ratio (ERR) of all K regressors
+  - `State`: (tuple of np.arrays) containing the ( R, z, ERR ) factorization of all K regressors to continue the factorization, None if stopped early since incomplete.
+    R and z are the ( Capacity, Capacity ) and ( Capacity, ) buffers of which only the first K rows/columns are used
+  '''
+
+  G = G.cpu().numpy(); c = c.cpu().numpy() # single transfer, everything below is K-sized
+  K = G.shape[0] # total number of regressors
+  k = K - G.shape[1] # number of already factorized regressors
+
+  ERR = np.full( K, 0.0, dtype = np.float64 ) # list of Error reduction ratios of all imposed regressors
+
+  if ( State is None ): State = ( np.zeros( ( 0, 0 ) ), np.zeros( 0 ), np.zeros( 0 ) ) # empty prefix: all prefix operations below are legal zero-sized ones
+
+  if ( State[0].shape[0] < K ): # (re-)allocate the buffers only if the factorization doesn't fit, the prefix is then copied once
+    Capacity = K if ( Capacity is None ) else max( K, Capacity )
+    R = np.zeros( ( Capacity, Capacity ), dtype = G.dtype ) # upper triangular factor G = R.T @ R, R[j, k] = < Omega_j, Ds[:, k] > / ||Omega_j||
+    z = np.zeros( Capacity, dtype = G.dtype ) # z = R^-T @ c, so z[k] = < Omega_k, y > / ||Omega_k||
+    R[:k, :k] = State[0][:k, :k]; z[:k] = State[1][:k]
+  
+  else: R, z = State[0], State[1] # rows >= k are still zero, so the factorization is simply continued in place
+
+  # Orthogonalize the new regressors against all the prefix's Omegas in one triangular solve
+  ERR[:k] = State[2]
+  Dead = np.flatnonzero( np.diagonal( R[:k, :k] ) == 0 ) # dependent regressors have a zero R row and are thus excluded from the solve
+  Rt = R[:k, :k].T.copy(); Rt[ Dead, Dead ] = 1.0 # make the system solvable, the zero rows guarantee that the dummy solutions aren't used by the other rows
+  R[:k, k:K] = spl.solve_triangular( Rt, G[:k], lower = True, check_finite = False )
+  R[ Dead, k:K ] = 0.0
+
+  ERR_Sum = np.sum( ERR[:k] ) # running sum of the ERRs for the early exit, updated in O(1) per regressor
+  for col in range( k, K ): # iterate over the new columns
+    if ( ERR_Sum >= 1 ): return ( ERR, None ) # R[1/3] early exit if max ERR reached
+    
+    n_Omega = G[col, col - k] - R[:col, col] @ R[:col, col] # squared euclidean norm of Omega = Ds[:, col] minus its projection on the previous Omegas
+    if ( n_Omega <= 1e-10 * G[col, col - k] + 1e-12 ): continue # (numerically) linearly dependent regressor or zero column: explains no variance, R row stays 0
+
+    n_Omega = np.sqrt( n_Omega ); R[col, col] = n_Omega
+    Inv_n = 1.0 / n_Omega # single division, multiplications below
+    z[col] = ( c[col - k] - R[:col, col] @ z[:col] ) * Inv_n
+    
+    Row = R[col, col + 1:K] # orthogonalize all following regressors against Omega at once, fused in the R row to avoid temporaries
+    np.matmul( R[:col, col], R[:col, col + 1:K], out = Row ) # GEMV of the previous rows' projections
+    np.subtract( G[col, col + 1 - k:], Row, out = Row ); Row *= Inv_n
+    ERR[col] = z[col]**2 / s2y # z[col]^2 = W[-1]^2 * n_Omega, so same as usual but without storing W
+    ERR_Sum += ERR[col]
+  
+  return ( ERR, ( R, z, ERR ) ) # R[2/3]
+
+
 # ############################################################################ Variable Selection Procedure #############################################################################
-def ComputeERR( y, Ds ):
+def ComputeERR( y, Ds, s2y = None ):
   ''' Imposed only part of the rFOrLSR, as only the ERR of imposed terms is computed and returned.
   
   ### Inputs:
   - `y`: (1D torch.Tensor) containing the system output vector
   - `Ds`: (2D torch.Tensor) containing the imposed terms
+  - `s2y`: (Optional: float) containing the precomputed y @ y, for repeated calls with the same y
 
   ### Outputs:
   - `ERR`: (np.array of float) containing the error reduction ratio (ERR) of the imposed terms in the same order as Ds
   '''
 
-  s2y = ( y @ y ).item() # mean free observation empiric variance
-  ERR = np.full( Ds.shape[1], 0.0, dtype = np.float64 ) # list of Error reduction ratios of all imposed regressors
-  Psi = tor.empty( ( len( y ), 0 ) ); Psi_n = tor.empty( ( len( y ), 0 ) ) # Create empty ( p, 0 )-sized matrices to simplify the code below
-
-  # First iteration treated separately since no orthogonalization and no entry in A, and requires some reshapes
-  Psi = Ds[:, 0, None] # unnormed orthogonal regressor matrix ( already centered ) reshaped as column
-  n_Omega = HF.Norm2( Psi ) # squared euclidean norm of Omega or fudge factor
-  Psi_n = Psi / n_Omega # normed orthogonal regressor matrix
-  ERR[0] = ( ( Psi_n.T @ y ).item() )**2 * n_Omega / s2y # W[-1]^2 * n_Omega/s2y ) as usual but without storing W
-  
-  for col in range( 1, Ds.shape[1] ): # iterate over columns, start after position 1
-    if ( np.sum( ERR[:col] ) >= 1 ): return ( ERR ) # R[1/2] early exit if max ERR reached, array is init with 1s
-    # Computations
-    Omega = Ds[:, col] - Psi_n @ ( Psi.T @ Ds[:, col] ) # orthogonalize only the current column ( no reshape needed )
-    n_Omega = HF.Norm2( Omega )  # squared euclidean norm of Omega or fudge factor
-    ERR[col] = ( ( Omega @ y ).item() / n_Omega )**2 * n_Omega / s2y # W[-1]^2 * n_Omega/s2y ) as usual but without storing W
-    
-    # Data storage, add current regressor
-    Psi = tor.column_stack( ( Psi, Omega ) ) # unnormed matrix
-    Psi_n = tor.column_stack( ( Psi_n, Omega / n_Omega ) ) # normed matrix
-  
-  return ( ERR ) # R[2/2]
+  if ( s2y is None ): s2y = ( y @ y ).item() # mean free observation empiric variance
+  G = tor.matmul( Ds.T, Ds ) # ( K, K )-sized Gram matrix: the only operation on ( p, K )-sized data, everything below is K-sized
+  c = tor.matmul( Ds.T, y ) # ( K, )-sized projections of y on the imposed terms
+
+  return ( _ExtendERR( G, c, s2y )[0] ) # R[3/3]
 
 
 # ############################################################################ Expansion Order Estimator #############################################################################
@@ -310,15 +438,18 @@ def ExpansionOrderEstimator( x, y, MaxLags = ( 15, 15 ), MaxOrder = 5, VarianceA
   ModelExplainedVariance = [ 0 ] # Summed ERR of all models orders. Start at 0 to represent the 0th order model, being a constant. The optimal constant is the mean of y being 0
   y_cut, RegMat, RegNames = CTors.Lagger( ( x, y ), MaxLags ) # Create the imposed lags
   y_cut -= y_cut.mean()
+  s2y = ( y_cut @ y_cut ).item() # identical for all orders, so computed once
   ProgressBar = tqdm.tqdm( desc = "Currently analyzed expansion order", unit = "" ) # Initialise progressbar without giving the max to have a counter
 
   # if less than Minvariance variance is explained, redo the analysis with a higher order model, since maxlag = max variance
   for ModelOrder in range( 1, MaxOrder + 1 ): 
     ProgressBar.update()
     RegMatTMP = CTors.Expander( RegMat, RegNames, ExpansionOrder = ModelOrder )[0] # take only the RegMat and ignore RegNames
+    if ( ModelOrder == 1 ): RegMatTMP = RegMatTMP.clone() # Expander returns RegMat itself, which must stay uncentered for the next orders
+    RegMatTMP.sub_( RegMatTMP.mean( axis = 0, keepdims = True ) ) # in-place centering, avoids a copy of the expanded dictionary
 
     # ComputeERR returns an Array of ERR and stops upon the first ERR > 1 entry and fills the rest of the array with 0, so re-clip the sum since %
-    ModelErr = min( 1.0, np.sum( ComputeERR( y_cut, RegMatTMP - RegMatTMP.mean( axis = 0, keepdims = True ) ) ) )
+    ModelErr = min( 1.0, np.sum( ComputeERR( y_cut, RegMatTMP, s2y = s2y ) ) )
     ModelExplainedVariance.append( ModelErr )
     
     if ( ModelExplainedVariance[-1] >= VarianceAcceptThreshold ): break # do while condition, +1 since next iteration will exceed limit
@@ -347,13 +478,14 @@ def ExpansionOrderEstimator( x, y, MaxLags = ( 15, 15 ), MaxOrder = 5, VarianceA
 
 
 # ############################################################################ Variable Selection Procedure #############################################################################
-def MaxLagsEstimator( x, y, ModelOrder, MaxLags = ( 15, 15 ), VarianceAcceptThreshold = 0.98, Plot = True, SaveFig = None ):
+def MaxLagsEstimator( x, y, ModelOrder, MaxLags = ( 15, 15 ), VarianceAcceptThreshold = 0.98, Plot = True, SaveFig = None, SinglePrecision = False, SkipValidCells = False ):
   '''Variable selection function determining the maximum lags for y and x for rFOrLSR dictionary sparcification.
   This function is NARMAX specific since lagged variables are checked using arbitrary-order polynomial NARX models rather than Taylor expansions.
   Everything in purple on the plot is below the VarianceAcceptThreshold.
   
   Note: For model order > 2, this function might be a lot slower than an Arbo with a large dictionary, so use only for analysis or for Dcs not fitting in memory.
   Note: If any of the recommended lags contain the maximum lag as passed by the user, then the passed lags are not sufficient an a warning will be printed.
+  Note: The Gram matrix of the largest dictionary ( MaxLags, ModelOrder ) is computed once on x's device and sliced for all cells, so it must fit in memory.
   
   ### Inputs:
   -`x`: (1D torch.Tensor) containing the system input vector
@@ -363,9 +495,13 @@ def MaxLagsEstimator( x, y, ModelOrder, MaxLags = ( 15, 15 ), VarianceAcceptThre
   -`VarianceAcceptThreshold`: ( float ) the minimum explained variance of the NARMAX expansion to estimate the needed delays
   -`Plot`: (bool) if True, the plot will be generated
   -`SaveFig`: (str) path to save the plot, only works if Plot = True
+  -`SinglePrecision`: (bool) if True, the dictionary's Gram matrix product is computed in float32 and converted back, which is faster especially on consumer GPUs.
+    This relies on x and y being centered beforehand: the Grid values then deviate by about 1e-7 to 5e-5 regardless of the signals' offsets, far below the resolution needed for the VarianceAcceptThreshold
+  -`SkipValidCells`: (bool) if True, cells whose neighbor with one lag less already exceeds the VarianceAcceptThreshold aren't computed but take that neighbor's value.
+    This is faster and doesn't change the Recommendations, but the Grid then only contains lower bounds in the valid region, which is thus plotted as a flat block
   
   ### Output:
-  - `Grid`: ( MaxLags[0], MaxLags[1] )-shaped np.array containing the ERR values displayed by the plot
+  - `Grid`: ( MaxLags[0], MaxLags[1] )-shaped np.array containing the ERR values displayed by the plot. If SkipValidCells = True, the valid cells contain lower bounds
   - `Recommendations`: (Dict) containing the optimal lags with the system with the minimal x & y, x, y lags.
   '''
   
@@ -377,30 +513,74 @@ def MaxLagsEstimator( x, y, ModelOrder, MaxLags = ( 15, 15 ), VarianceAcceptThre
     if ( not Plot ): raise AssertionError( "SaveFig can only be used if Plot = True" )
     SaveFig = SaveFig.replace( "\\", "/" ) # Security
   
-  y = tor.ravel( y )
-  x = tor.ravel( x )
+  # Centered beforehand as the cells' ERR sums are shift-invariant but the G - outer( Sums, Sums ) / p centering below cancels catastrophically on signals with an offset
+  y = tor.ravel( y ) - y.mean()
+  x = tor.ravel( x ) - x.mean()
   
   # --------------------------------------------------------------------------------- A) Model computation ------------------------------------------------------------------------------
   print( f"\nComputing the Grid with maximum lags at ({ MaxLags[0] }, { MaxLags[1] }) and for a model order of { ModelOrder }:" )
-  Grid = np.full( ( MaxLags[1] + 1, MaxLags[0] + 1 ), np.nan ) # y's are rows and the x's columns to have a correct graph orientation, +1 due to x[k], y[k]
+  Grid = np.empty( ( MaxLags[1] + 1, MaxLags[0] + 1 ) ) # y's are rows and the x's columns to have a correct graph orientation, +1 due to x[k], y[k]. Every cell is written by the loop below
   ProgressBar = tqdm.tqdm( total = Grid.size ) # Initialise progressbar while declaring total number of iterations
 
-  # Unintuitively, it's the ComputeERR which accounts for 99.99% of the time, not both CTors, so optimizing that out isn't of interest.
-  # Also y_cut has a different length at each iteration so it can't be stored
-  for na in range( MaxLags[1] + 1 ): # iterate over y lags, +1 to contain the end-of-range value
-    for nb in range( MaxLags[0] + 1 ): # iterate over x lags, +1 to contain the end-of-range value
+  # All cells' regressors are columns of the largest dictionary. It's built once over all samples by zero-padding the signals' beginning, the padded rows are never used by cells with smaller lags.
+  q_Max = max( MaxLags )
+  _, RegMat, RegNames = CTors.Lagger( Data = ( tor.cat( ( x.new_zeros( q_Max ), x ) ), tor.cat( ( y.new_zeros( q_Max ), y ) ) ), Lags = MaxLags )
+  RegMat, RegNames = CTors.Expander( RegMat, RegNames, ExpansionOrder = ModelOrder )
+  Position = { Name: i for i, Name in enumerate( RegNames ) }
+  
+  # Uncentered statistics over the rows q: (here q = 0), from which each cell's centered Gram matrix is sliced: this is the only operation on ( p, K )-sized data
+  if ( SinglePrecision ): RegMat32 = RegMat.to( tor.float32 ); G = ( RegMat32.T @ RegMat32 ).to( RegMat.dtype ); del RegMat32 # halved bytes for the single large GEMM, only accurate thanks to the pre-centering of x and y
+  else:                  G = RegMat.T @ RegMat # Gram matrix
+  c = RegMat.T @ y; Sums = RegMat.sum( axis = 0 ) # projections, column sums: cheap, so kept in full precision like the downdates
+  y_Sum = y.sum().item(); y_Sq = ( y @ y ).item(); p = len( y ) # output sum, squared norm and number of samples
+
+  # The grid is traversed in shells of identical maximum lag q = max( na, nb ), since those cells share y_cut's rows. Within a shell, the cells extend each other by one lag:
+  # first the x-lag column ( nb = q, na = 0 → q-1 ), then the y-lag row ( na = q, nb = 0 → q ). Thus each cell only factorizes the regressors not in the previous cell.
+  Cells = []
+  for q in range( q_Max + 1 ):
+    if ( q <= MaxLags[0] ): Cells += [ ( na, q ) for na in range( min( q, MaxLags[1] + 1 ) ) ] # x-lag column, without the corner
+    if ( q <= MaxLags[1] ): Cells += [ ( q, nb ) for nb in range( min( q, MaxLags[0] ) + 1 ) ] # y-lag row, with the corner
+  
+  q_Current = 0 # first row of the samples contained in G, c, Sums, etc
+  Previous = None # ( q, column indices, State ) of the last computed cell to be extended by the next one
+
+  for ( na, nb ) in Cells: # both neighbors ( na-1, nb ) and ( na, nb-1 ) are computed beforehand by the shell structure
+    
+    Neighbor = max( Grid[ na-1, nb ] if ( na > 0 ) else 0.0, Grid[ na, nb-1 ] if ( nb > 0 ) else 0.0 ) # best explained variance of the cells with one lag less
+    
+    # Adding regressors never lowers the explained variance, so a neighbor at full precision makes the cell exactly 1.0 and one above the threshold makes it valid
+    if ( ( Neighbor >= 1.0 ) or ( SkipValidCells and ( Neighbor > VarianceAcceptThreshold ) ) ):
+      Grid[ na, nb ] = Neighbor # propagate the neighbor's value rather than recomputing unnecessarily everything
+    
+    else:
+      for row in range( q_Current, max( na, nb ) ): # new shell: remove the rows swung-in by the longer lags via rank-1 downdates
+        G.addr_( RegMat[row], RegMat[row], alpha = -1 ); c -= RegMat[row] * y[row]; Sums -= RegMat[row]
+        y_Sum -= y[row].item(); y_Sq -= y[row].item()**2; p -= 1
+      q_Current = max( q_Current, max( na, nb ) )
       
-      if ( ( Grid[ max( na-1, 0 ), nb] == 1.0 ) and ( Grid[ na, max( nb-1, 0 )] == 1.0 ) ): 
-        Grid[ na, nb ] = 1.0 # if both previous regressor lists are already sufficient to achive full precision, don't recompute unnecessarily everything
+      # The cell's regressors are found by name, only constructed on a single sample since only RegNames are needed
+      _, CellMat, CellNames = CTors.Lagger( Data = ( x[ : q_Current + 1 ], y[ : q_Current + 1 ] ), Lags = ( nb, na ) )
+      CellIdx = [ Position[Name] for Name in CTors.Expander( CellMat, CellNames, ExpansionOrder = ModelOrder )[1] ]
       
-      else:
-        y_cut, RegMat, RegNames = CTors.Lagger( Data = ( x, y ), Lags = ( nb, na ) ) # construct linear regressor matrix, ignore RegNames return
-        RegMat, RegNames = CTors.Expander( RegMat, RegNames, ExpansionOrder = ModelOrder )
-        
-        ERRArray = ComputeERR( y_cut - y_cut.mean(), RegMat - RegMat.mean( axis = 0, keepdims = True ) ) # Returns an Array of ERR (clipped to 1)
-        Grid[na, nb] = min( 1.0, np.sum( ERRArray ) ) # ComputeERR stops upon the first ERR > 1 entry and fills the rest of the array with 1, so re-clip the sum
+      # Reuse the previous factorization if it's a prefix of the current one: same rows and all regressors contained
+      if ( ( Previous is not None ) and ( Previous[0] == q_Current ) and set( Previous[1] ).issubset( CellIdx ) ):
+        Known = set( Previous[1] ); State = Previous[2]
+        Order = Previous[1] + [ idx for idx in CellIdx if ( idx not in Known ) ] # already factorized regressors first, in the same order
+      else: Order = CellIdx; State = None
+
+      k = 0 if ( State is None ) else len( State[2] ) # number of already factorized regressors
+      Order_t = tor.tensor( Order, device = G.device ); New_t = Order_t[k:]
+      
+      # Centered statistics: sum( ( a - mean( a ) ) * ( b - mean( b ) ) ) = sum( a * b ) - sum( a ) * sum( b ) / p
+      G_Cell = G[ Order_t[:, None], New_t[None, :] ] - tor.outer( Sums[Order_t], Sums[New_t] ) / p
+      c_Cell = c[New_t] - Sums[New_t] * y_Sum / p
+      
+      ERRArray, State = _ExtendERR( G_Cell, c_Cell, y_Sq - y_Sum**2 / p, State, Capacity = len( RegNames ) ) # buffers sized for the largest dictionary
+      Grid[na, nb] = min( 1.0, np.sum( ERRArray ) ) # ComputeERR stops upon the first ERR > 1 entry and fills the rest of the array with 1, so re-clip the sum
+      
+      Previous = None if ( State is None ) else ( q_Current, Order, State ) # only a single factorization is kept in memory
 
-      ProgressBar.update() # increase count
+    ProgressBar.update() # increase count
   ProgressBar.close() # Necessary
   
   # --------------------------------------------------------------------------------- B) Lags recommendation -----------------------------------------------------------------------------------
@@ -409,23 +589,18 @@ def MaxLagsEstimator( x, y, ModelOrder, MaxLags = ( 15, 15 ), VarianceAcceptThre
                       "Min_Y":  ( MaxLags[0], MaxLags[1] ), # Position with the smallest y lag
                     }
   
-  BestIdx = np.inf
-
-  for na in range( MaxLags[1] + 1 ): # over y-lags
-    for nb in range( MaxLags[0] + 1 ): # over x-lags
-      if ( Grid[ na, nb ] > VarianceAcceptThreshold ): # valid solution
-        if ( na + nb < BestIdx ): # Smallest a+b position. Taking <= would allow more y terms in, yielding less numereically stable solution systems
-          BestIdx = na + nb
-          Recommendations["Min_XY"] = ( nb, na ) # x-lags then y-lags
+  Valid = ( Grid > VarianceAcceptThreshold ) # valid solutions
 
-  for na in range( MaxLags[1] + 1 ): # iterate over y values (rows), since we're looking for the smallest nb with the smallest na
-    BestIdx = np.argmax( Grid[ na, : ] > VarianceAcceptThreshold ) # find first nb > VarianceAcceptThreshold.
-    if ( BestIdx != 0 ): Recommendations["Min_Y"] = ( BestIdx, na ); break
+  if ( Valid.any() ):
+    Idx = np.argwhere( Valid ) # ( na, nb ) positions in row-major order
+    Best = np.argmin( Idx.sum( axis = 1 ) ) # first smallest a+b position. Taking the last would allow more y terms in, yielding less numereically stable solution systems
+    Recommendations["Min_XY"] = ( int( Idx[Best, 1] ), int( Idx[Best, 0] ) ) # x-lags then y-lags
 
-  for nb in range( MaxLags[0] + 1 ): # iterate over x values (columns), since we're looking for the smallest na with the smallest nb
-    BestIdx = np.argmax( Grid[ : , nb ] > VarianceAcceptThreshold ) # find the first na > VarianceAcceptThreshold.
-    if ( BestIdx != 0 ): Recommendations["Min_X"] = ( nb, BestIdx ); break
+    na = np.argmax( Valid.any( axis = 1 ) ) # smallest y lag (row) having a valid solution
+    Recommendations["Min_Y"] = ( int( np.argmax( Valid[na, :] ) ), int( na ) ) # with the smallest x lag in that row
 
+    nb = np.argmax( Valid.any( axis = 0 ) ) # smallest x lag (column) having a valid solution
+    Recommendations["Min_X"] = ( int( nb ), int( np.argmax( Valid[:, nb] ) ) ) # with the smallest y lag in that column
 
   if ( np.max( Grid ) < VarianceAcceptThreshold ): print( "\nWARNING: The passed MaxLags don't suffise for the desired variance\n" )
   # ---------------------------------------------------------------------------------- C) Plot ---------------------------------------------------------------------------------------